@@ -6,14 +6,29 @@ JSON file is outputted by system call analysis tool.
 """
 
 import os
+import mmap
+import re
 import sys
+import csv
 import json
+import hashlib
 import argparse
+import functools
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import xlrd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
+# Use orjson to parse application JSON files if available.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
 
 # Folder storing application JSON files from syscall analysis tool:
 # one JSON file per-application
@@ -23,6 +38,12 @@ APPLICATION_JSON_FOLDER = 'to_aggregate'
 # TODO: Use Google DOC API.
 SHEET_FILENAME = 'Unikraft - Syscall Status - no-fork.xls'
 
+# CSV export of the first three columns of SHEET_FILENAME, used instead of
+# it when present and up to date. Its first line records the SHA-1 digest
+# of the spreadsheet it was exported from (see export_syscall_csv).
+SHEET_CSV_FILENAME = 'Unikraft - Syscall Status - no-fork.csv'
+SHEET_CSV_DIGEST_PREFIX = '# sha1: '
+
 # Columns to consider in the excel file
 NB_COLS = 3
 
@@ -30,16 +51,55 @@ INDEX_RAX = 0 #syscall number (col: 0)
 INDEX_NAME = 1 #syscall name   (col: 1)
 INDEX_STATUS = 2 #syscall status (col: 2)
 
+# Application JSON files larger than this (in bytes) are memory-mapped and
+# parsed in place by orjson, instead of being read into memory first.
+JSON_MMAP_THRESHOLD = 1 << 20
+
+# Application JSON folders larger than this (in bytes, all files together)
+# are parsed in a process pool. Below it, starting the workers costs more
+# than parsing the files.
+JSON_POOL_THRESHOLD = 64 << 20
+
 # Keys in JSON files
 STATIC_DATA = "static_data"
 DYNAMIC_DATA = "dynamic_data"
 SYSCALLS_DATA = "system_calls"
 
+# Map substrings of the spreadsheet status column to status keys.
+# Keys are listed by priority: if a status matches several of them, the first
+# listed one wins, wherever it is in the status.
+STATUS_MAP = {
+    'incomplete': "INCOMPLETE",
+    'registration missing': "REG_MISS",
+    'stubbed': "STUBBED",
+    'planned': "PLANNED",
+    'progress': "IN_PROGRESS",
+    'broken': "BROKEN",
+    'okay': "OKAY"
+    }
+STATUS_PRIORITY = {key: i for i, key in enumerate(STATUS_MAP.values())}
+# Lookahead, so that findall() also returns overlapping matches.
+STATUS_RE = re.compile('(?=(' + '|'.join(map(re.escape, STATUS_MAP)) + '))')
+
+# Status keys of the per-application system call lists (apps)
+STATUSES = ("OKAY", "ABSENT", "NOT_IMPL", "INCOMPLETE", "REG_MISS", "STUBBED",
+            "BROKEN", "IN_PROGRESS", "PLANNED")
+STATUS_IDX = {s: i for i, s in enumerate(STATUSES)}
+
+# Header of the per-application CSV output (print_apps)
+APPS_CSV_HEADER = ("app", "total", "okay", "not_impl", "reg_miss",
+                   "incomplete", "stubbed", "planned", "broken",
+                   "in_progress", "absent")
+
+# Header of the per-syscall CSV output (print_syscalls)
+SYSCALLS_CSV_HEADER = ("syscall", "status", "num_apps")
+
 
 # Applications dictionary, indexed by application name
-# Each item in the dictionary is another dictionary with list of system calls
-# in the various states. Each inner dictionary uses the status as key: "OKAY",
-# "ABSENT", "NOT_IMPL", "INCOMPLETE", "REG_MISS", "STUBBED", "BROKEN",
+# Each item in the dictionary is a defaultdict with one list of system calls
+# per status, indexed by STATUS_IDX[status]. Only statuses used by the
+# application have a list. Statuses are listed in STATUSES:
+# "OKAY", "ABSENT", "NOT_IMPL", "INCOMPLETE", "REG_MISS", "STUBBED", "BROKEN",
 # "IN_PROGRESS", "PLANNED".
 apps = {}
 
@@ -63,67 +123,69 @@ syscalls = {}
 undefined_syscalls = {}
 
 
-def process_application_json(app_name, json_data):
-    """Fill apps, syscalls and undefined_syscalls dictionaries.
+def application_syscalls(json_data):
+    """Extract the set of system calls used by an application.
 
-    Extract syscall related information from each application JSON file.
-    Application name and application JSON data are passed as arguments.
+    Application JSON data is passed as argument.
     """
 
-    # Extract all system calls in the JSON file in local_set.
     local_set = set()
 
     # First parse static data.
     if STATIC_DATA in json_data:
-        static_data = json_data[STATIC_DATA][SYSCALLS_DATA]
-        for symbol in static_data:
-            local_set.add(symbol)
+        local_set.update(json_data[STATIC_DATA].get(SYSCALLS_DATA, ()))
 
     # Then parse dynamic data.
     if DYNAMIC_DATA in json_data:
-        dynamic_data = json_data[DYNAMIC_DATA][SYSCALLS_DATA]
-        for symbol in dynamic_data:
-            local_set.add(symbol)
+        local_set.update(json_data[DYNAMIC_DATA].get(SYSCALLS_DATA, ()))
+
+    return local_set
+
+
+def process_application_syscalls(app_name, local_set):
+    """Fill apps, syscalls and undefined_syscalls dictionaries.
+
+    Application name and the set of system calls it uses are passed as
+    arguments.
+    """
 
     # Construct application dictionary (apps).
-    apps[app_name] = {
-        "OKAY": [],
-        "ABSENT": [],
-        "NOT_IMPL": [],
-        "INCOMPLETE": [],
-        "REG_MISS": [],
-        "STUBBED": [],
-        "BROKEN": [],
-        "IN_PROGRESS": [],
-        "PLANNED": []
-        }
+    buckets = apps[app_name] = defaultdict(list)
+
+    # Bucket each system call by status, update syscall dictionary with
+    # application list and construct undefined_syscalls dictionary.
+    absent_idx = STATUS_IDX["ABSENT"]
     for symbol in local_set:
-        if symbol in syscalls.keys():
-            status = syscalls[symbol]['status']
+        entry = syscalls.get(symbol)
+        if entry is not None:
+            buckets[STATUS_IDX[entry['status']]].append(symbol)
         else:
-            status = "ABSENT"
-        apps[app_name][status].append(symbol)
+            buckets[absent_idx].append(symbol)
+            entry = undefined_syscalls.setdefault(symbol, {
+                'name': symbol,
+                'apps': [],
+                'num_apps': 0
+                })
+        entry['apps'].append(app_name)
+        entry['num_apps'] += 1
 
-    # Update syscall dictionary with application list.
-    # Construct undedefine_syscalls dictionary.
-    for symbol in local_set:
-        found = False
-        for s in syscalls:
-            if s == symbol:
-                found = True
-                break
-        if found:
-            syscalls[symbol]['apps'].append(app_name)
-            syscalls[symbol]['num_apps'] += 1
+
+def load_application_syscalls(filepath):
+    """Load one per-application JSON file.
+
+    Return a tuple with the application name and the set of system calls
+    it uses.
+    """
+
+    with open(filepath, 'rb') as json_file:
+        size = os.fstat(json_file.fileno()).st_size
+        if orjson is not None and size > JSON_MMAP_THRESHOLD:
+            with mmap.mmap(json_file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+                json_data = orjson.loads(buf)
         else:
-            if not symbol in undefined_syscalls:
-                undefined_syscalls[symbol] = {
-                    'name': symbol,
-                    'apps': [],
-                    'num_apps': 0
-                    }
-            undefined_syscalls[symbol]['apps'].append(app_name)
-            undefined_syscalls[symbol]['num_apps'] += 1
+            json_data = json_loads(json_file.read())
+    return os.path.basename(filepath)[:-5], application_syscalls(json_data)
 
 
 def walk_application_json_folder(path):
@@ -132,14 +194,54 @@ def walk_application_json_folder(path):
     Read each per-application JSON file and process it.
     """
 
-    for subdir, _, files in os.walk(path):
-        for file in sorted(files):
-            filepath = subdir + os.sep + file
+    # Collect JSON files, sorted by name in each folder, visiting
+    # subfolders in order after the files of their parent folder.
+    filepaths = []
+    total_size = 0
+    folders = [path]
+    while folders:
+        with os.scandir(folders.pop()) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        subfolders = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+            elif entry.is_file() and entry.name.endswith(".json"):
+                filepaths.append(entry.path)
+                total_size += entry.stat().st_size
+        folders.extend(reversed(subfolders))
+
+    # Large folders are parsed in worker processes, which only send back
+    # the system call sets. These are processed here, in order, so that
+    # only this process updates the dictionaries.
+    if total_size > JSON_POOL_THRESHOLD and (os.cpu_count() or 1) > 1:
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(load_application_syscalls,
+                                        filepaths, chunksize=8))
+    else:
+        results = map(load_application_syscalls, filepaths)
+
+    for app_name, local_set in results:
+        process_application_syscalls(app_name, local_set)
+
+
+@functools.lru_cache(maxsize=None)
+def classify_status(status_str):
+    """Return the status key of a spreadsheet status.
+
+    Known statuses are mapped to status keys (see STATUS_MAP), empty
+    statuses are not implemented and unknown ones are kept as they are.
+    Results are cached, as the status column only holds a few distinct
+    values.
+    """
+
+    if len(status_str) == 0:
+        return 'NOT_IMPL'
 
-            if filepath.endswith(".json"):
-                with open(filepath) as json_file:
-                    json_data = json.load(json_file)
-                    process_application_json(file[:-5], json_data)
+    matches = STATUS_RE.findall(status_str)
+    if matches:
+        return min(map(STATUS_MAP.get, matches), key=STATUS_PRIORITY.get)
+    return sys.intern(status_str)
 
 
 def process_syscall_spreadsheet(filename):
@@ -154,80 +256,147 @@ def process_syscall_spreadsheet(filename):
     Return value is data_sheet, a list of three lists, one for each column.
     """
 
-    data_sheet = list()
+    data_sheet = [list() for _ in range(NB_COLS)]
 
-    book = xlrd.open_workbook(filename)
+    # Only load the first sheet, without formatting information.
+    book = xlrd.open_workbook(filename, on_demand=True, formatting_info=False)
     worksheet = book.sheet_by_index(0)
 
-    # Init the data_sheet with 3 sublists
-    for _ in range(NB_COLS):
-        data_sheet.append(list())
+    # Skip the header row.
+    rows = worksheet.get_rows()
+    next(rows, None)
 
     # Populate data_sheet with cell values (COLS: 0, 1, 2)
-    for row in range(1, worksheet.nrows):
+    for row in rows:
         try:
-            data_sheet[INDEX_RAX].append(int(
-                worksheet.cell_value(row, INDEX_RAX)))
+            data_sheet[INDEX_RAX].append(int(row[INDEX_RAX].value))
         except ValueError:
             # This is not a number, change it to -1
             data_sheet[INDEX_RAX].append(-1)
 
-        data_sheet[INDEX_NAME].append(
-            worksheet.cell_value(row, INDEX_NAME))
-
-        status_str = worksheet.cell_value(row, INDEX_STATUS)
-        if len(status_str) == 0:
-            status_str = 'NOT_IMPL'
-        elif 'incomplete' in status_str:
-            status_str = "INCOMPLETE"
-        elif 'registration missing' in status_str:
-            status_str = "REG_MISS"
-        elif 'stubbed' in status_str:
-            status_str = "STUBBED"
-        elif 'planned' in status_str:
-            status_str = "PLANNED"
-        elif 'progress' in status_str:
-            status_str = "IN_PROGRESS"
-        elif 'broken' in status_str:
-            status_str = "BROKEN"
-        elif 'okay' in status_str:
-            status_str = "OKAY"
-        data_sheet[INDEX_STATUS].append(status_str)
+        # Names are interned, as they are used as dictionary keys.
+        data_sheet[INDEX_NAME].append(sys.intern(str(row[INDEX_NAME].value)))
+
+        data_sheet[INDEX_STATUS].append(
+            classify_status(str(row[INDEX_STATUS].value)))
+
+    book.release_resources()
+
+    return data_sheet
+
+
+def process_syscall_csv(filename):
+    """Interpret syscall status spreadsheet exported as CSV (.csv).
+
+    Columns are the same as in process_syscall_spreadsheet(), as is the
+    return value.
+    """
+
+    data_sheet = [list() for _ in range(NB_COLS)]
+
+    with open(filename, newline='', encoding='utf-8') as csv_file:
+        # Skip the spreadsheet digest line, if any, and the header row.
+        # Only the first line is read by hand, so that fields spanning
+        # several lines are still handled by the csv module.
+        if csv_file.readline().startswith(SHEET_CSV_DIGEST_PREFIX):
+            csv_file.readline()
+        rows = csv.reader(csv_file)
+
+        for row in rows:
+            # Skip blank or incomplete rows.
+            if len(row) < NB_COLS:
+                continue
+
+            try:
+                data_sheet[INDEX_RAX].append(int(row[INDEX_RAX]))
+            except ValueError:
+                # This is not a number, change it to -1
+                data_sheet[INDEX_RAX].append(-1)
+
+            data_sheet[INDEX_NAME].append(sys.intern(row[INDEX_NAME]))
+            data_sheet[INDEX_STATUS].append(classify_status(row[INDEX_STATUS]))
 
     return data_sheet
 
 
+def sheet_digest(filename):
+    """Return the SHA-1 digest of the spreadsheet file.
+    """
+    with open(filename, 'rb') as sheet_file:
+        return hashlib.sha1(sheet_file.read()).hexdigest()
+
+
+def csv_export_is_current(csv_filename, sheet_filename):
+    """Check whether the CSV file was exported from the current version of
+    the spreadsheet file.
+    """
+    with open(csv_filename, encoding='utf-8') as csv_file:
+        first_line = csv_file.readline().rstrip('\r\n')
+    return first_line == SHEET_CSV_DIGEST_PREFIX + sheet_digest(sheet_filename)
+
+
+def export_syscall_csv(sheet_filename, csv_filename):
+    """Export the first three columns of the syscall status spreadsheet
+    (including the header row) to a CSV file.
+
+    The first line of the CSV file records the digest of the spreadsheet.
+    """
+
+    book = xlrd.open_workbook(sheet_filename, on_demand=True,
+                              formatting_info=False)
+    worksheet = book.sheet_by_index(0)
+
+    with open(csv_filename, 'w', newline='', encoding='utf-8') as csv_file:
+        csv_file.write(SHEET_CSV_DIGEST_PREFIX + sheet_digest(sheet_filename)
+                       + '\n')
+        writer = csv.writer(csv_file, lineterminator='\n')
+        for row in worksheet.get_rows():
+            values = []
+            for cell in row[:NB_COLS]:
+                value = cell.value
+                # Write integral numbers (syscall ids) without decimals.
+                if isinstance(value, float) and value.is_integer():
+                    value = int(value)
+                values.append(value)
+            writer.writerow(values)
+
+    book.release_resources()
+
+
+def count_app_statuses(app):
+    """Return the number of system calls per status for an application,
+    as a list in STATUSES order.
+    """
+    buckets = apps[app]
+    return [len(buckets.get(i, ())) for i in range(len(STATUSES))]
+
+
 def print_apps():
     """Print apps dictionary as comma-separated values (CSV).
     """
-    print("{},{},{},{},{},{},{},{},{},{},{}".format(
-        "app", "total", "okay", "not_impl", "reg_miss", "incomplete",
-        "stubbed", "planned", "broken", "in_progress", "absent"))
+    rows = []
     for a in apps:
-        okay = len(apps[a]['OKAY'])
-        not_impl = len(apps[a]["NOT_IMPL"])
-        incomplete = len(apps[a]["INCOMPLETE"])
-        reg_miss = len(apps[a]["REG_MISS"])
-        stubbed = len(apps[a]["STUBBED"])
-        planned = len(apps[a]["PLANNED"])
-        in_progress = len(apps[a]["IN_PROGRESS"])
-        broken = len(apps[a]["BROKEN"])
-        absent = len(apps[a]["ABSENT"])
+        (okay, absent, not_impl, incomplete, reg_miss, stubbed, broken,
+         in_progress, planned) = count_app_statuses(a)
         total = okay + not_impl + incomplete + reg_miss + stubbed + planned + in_progress + broken
-        print("{},{},{},{},{},{},{},{},{},{},{}".format(
-            a, total, okay, not_impl, reg_miss, incomplete,
-            stubbed, planned, broken, in_progress, absent))
+        rows.append((a, total, okay, not_impl, reg_miss, incomplete,
+                     stubbed, planned, broken, in_progress, absent))
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(APPS_CSV_HEADER)
+    writer.writerows(rows)
 
 
 def print_syscalls():
     """Print system calls from syscalls and undefined_syscalls dictionary
     as comma-separated values (CSV).
     """
-    print("{},{},{}".format("syscall", "status", "num_apps"))
-    for s in syscalls:
-        print("{},{},{}".format(s, syscalls[s]['status'], len(syscalls[s]['apps'])))
-    for s in undefined_syscalls:
-        print("{},{},{}".format(s, 'ABSENT', len(undefined_syscalls[s]['apps'])))
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(SYSCALLS_CSV_HEADER)
+    writer.writerows((s, syscalls[s]['status'], len(syscalls[s]['apps']))
+                     for s in syscalls)
+    writer.writerows((s, 'ABSENT', len(undefined_syscalls[s]['apps']))
+                     for s in undefined_syscalls)
 
 
 def top_not_supported_syscalls(top):
@@ -246,16 +415,9 @@ def top_not_supported_syscalls(top):
 
 
 def get_not_supported_except(app, except_list):
-    not_impl = len(apps[app]["NOT_IMPL"])
-    incomplete = len(apps[app]["INCOMPLETE"])
-    reg_miss = len(apps[app]["REG_MISS"])
-    stubbed = len(apps[app]["STUBBED"])
-    planned = len(apps[app]["PLANNED"])
-    in_progress = len(apps[app]["IN_PROGRESS"])
-    broken = len(apps[app]["BROKEN"])
-    absent = len(apps[app]["ABSENT"])
-
-    not_supported_list = apps[app]["NOT_IMPL"] + apps[app]["PLANNED"]
+    buckets = apps[app]
+    not_supported_list = (buckets.get(STATUS_IDX["NOT_IMPL"], [])
+                          + buckets.get(STATUS_IDX["PLANNED"], []))
     initial = len(not_supported_list)
 
     for s in except_list:
@@ -277,15 +439,8 @@ def collect_app_syscalls_supported():
     #print(top_5_not_supported)
     #print(top_10_not_supported)
     for a in apps:
-        okay = len(apps[a]['OKAY'])
-        not_impl = len(apps[a]["NOT_IMPL"])
-        incomplete = len(apps[a]["INCOMPLETE"])
-        reg_miss = len(apps[a]["REG_MISS"])
-        stubbed = len(apps[a]["STUBBED"])
-        planned = len(apps[a]["PLANNED"])
-        in_progress = len(apps[a]["IN_PROGRESS"])
-        broken = len(apps[a]["BROKEN"])
-        absent = len(apps[a]["ABSENT"])
+        (okay, absent, not_impl, incomplete, reg_miss, stubbed, broken,
+         in_progress, planned) = count_app_statuses(a)
         total = okay + not_impl + incomplete + reg_miss + stubbed + planned + in_progress + broken
         not_supported = not_impl + planned
         not_supported_except_top_5 = get_not_supported_except(a, top_5_not_supported)
@@ -446,21 +601,36 @@ def main():
                         help='Plot syscall support')
     parser.add_argument('-m', '--missing', action='store_true',
                         help='Percentage of syscalls missing per app')
+    parser.add_argument('-e', '--export-csv', action='store_true',
+                        help='Export system call status spreadsheet to CSV')
     args = parser.parse_args()
 
-    data_sheet = process_syscall_spreadsheet(SHEET_FILENAME)
+    if args.export_csv:
+        export_syscall_csv(SHEET_FILENAME, SHEET_CSV_FILENAME)
+
+    # Prefer the CSV export, unless the spreadsheet was updated since.
+    data_sheet = None
+    if os.path.exists(SHEET_CSV_FILENAME):
+        if not os.path.exists(SHEET_FILENAME) \
+                or csv_export_is_current(SHEET_CSV_FILENAME, SHEET_FILENAME):
+            data_sheet = process_syscall_csv(SHEET_CSV_FILENAME)
+        else:
+            print("[WARNING] {} is out of date, reading {} instead "
+                  "(use --export-csv to update it)".format(
+                      SHEET_CSV_FILENAME, SHEET_FILENAME), file=sys.stderr)
+    if data_sheet is None:
+        data_sheet = process_syscall_spreadsheet(SHEET_FILENAME)
     ids = data_sheet[0]
     names = data_sheet[1]
     stats = data_sheet[2]
 
-    for i in range(len(ids)):
-        syscalls[names[i]] = {
-            "id": ids[i],
-            "name": names[i],
-            "status": stats[i],
-            "apps": [],
-            "num_apps": 0
-            }
+    syscalls.update({name: {
+        "id": i,
+        "name": name,
+        "status": status,
+        "apps": [],
+        "num_apps": 0
+        } for i, name, status in zip(ids, names, stats)})
     # Read folder with application JSON files and aggregate the data.
     walk_application_json_folder(APPLICATION_JSON_FOLDER)
 